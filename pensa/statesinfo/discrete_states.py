@@ -1,15 +1,34 @@
+import functools
 import numpy as np
-from queue import PriorityQueue 
 import math
-import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
 from scipy.signal import argrelextrema
-import os
+from scipy.special import erf
 from pensa.features import *
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 
 # -- Functions to cluster feature distributions into discrete states --
 
+_SQRT2 = np.sqrt(2)
+
+
+@functools.lru_cache(maxsize=64)
+def _window(window_type, window_len):
+    """
+    Normalised window coefficients for _smooth, cached since the same
+    (type, length) pair is requested on every fit attempt.
+    """
+    if window_type == 'flat': #moving average
+        w = np.ones(window_len,'d')
+    else:
+        w = getattr(np, window_type)(window_len)
+    return w/w.sum()
+
 
 def _smooth(x,window_len,window=None):
     """
@@ -46,12 +65,11 @@ def _smooth(x,window_len,window=None):
         return x
     if not window_type in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
         raise ValueError
-    s=np.r_[x[window_len-1:0:-1],x,x[-2:-window_len-1:-1]]
-    if window_type  ==  'flat': #moving average
-        w=np.ones(window_len,'d')
-    else:
-        w=eval('np.'+window_type+'(window_len)')
-    y=np.convolve(w/w.sum(),s,mode='valid')
+    s=np.pad(x,window_len-1,mode='reflect')
+    w_norm=_window(window_type,window_len)
+    ##direct convolution only: FFT paths leave ~1-ulp noise in flat regions,
+    ##which the strict-inequality extrema search turns into phantom peaks
+    y=np.convolve(w_norm,s,mode='valid')
     return y
 
 def _find_nearest(distr, value):
@@ -71,118 +89,93 @@ def _find_nearest(distr, value):
         Closest value to reference value in distribution.
 
     """
-    array = np.array(distr)
+    array = np.asarray(distr)
     idx = (np.abs(array - value)).argmin()
     return array[idx]
 
-def _printKclosest(arr,n,x,k): 
+def _density_histo(values, lo, hi, gauss_bin):
+    """
+    Density-normalised histogram over gauss_bin regular bins spanning
+    [lo, hi]. Equivalent to np.histogram(..., density=True) but bins in
+    a single pass via np.bincount on precomputed bin indices.
+    """
+    idx = np.clip(((values - lo)/(hi - lo)*gauss_bin).astype(np.int64), 0, gauss_bin - 1)
+    counts = np.bincount(idx, minlength=gauss_bin).astype(np.float64)
+    return counts/(counts.sum()*(hi - lo)/gauss_bin)
+
+def _multimodal_kernel(x, p):
+    """
+    Accumulate all Gaussian components of a (K,3) parameter array into
+    one output pass. JIT-compiled when numba is available, which fuses
+    the subtract/exp/multiply chain instead of materialising a temporary
+    array per operation.
+    """
+    out = np.zeros(x.size)
+    for comp in range(p.shape[0]):
+        mu = p[comp, 0]
+        inv2s2 = 1.0 / (2.0 * p[comp, 1] * p[comp, 1])
+        A = p[comp, 2]
+        for point in range(x.size):
+            out[point] += A * np.exp(-(x[point] - mu)**2 * inv2s2)
+    return out
+
+if njit is not None:
+    _multimodal_kernel = njit(fastmath=True, cache=True)(_multimodal_kernel)
+
+def _multimodal(x, *params):
     """
-    Print K closest values to a specified value. 
+    Mixture of an arbitrary number of Gaussians, parametrised by a flat
+    sequence of (mean, sigma, amplitude) triples.
 
     Parameters
     ----------
-    arr : list
-        The distribution of values.
-    n : int
-        Search through the first n values of arr for k closest values.
-    x : float
-        The reference value for which the closest values are sought.
-    k : int
-        Number of closest values desired.
+    x : list
+        x-axis distribution.
+    *params : float
+        Flattened Gaussian parameters, three (mu, sigma, A) per component.
 
     Returns
     -------
-    a : list
-        The closest k values to x.
-
-    """
-    a=[]
-    # Make a max heap of difference with  
-    # first k elements.  
-    pq = PriorityQueue() 
-    for neighb in range(k): 
-        pq.put((-abs(arr[neighb]-x),neighb)) 
-    # Now process remaining elements 
-    for neighb in range(k,n): 
-        diff = abs(arr[neighb]-x) 
-        p,pi = pq.get() 
-        curr = -p 
-        # If difference with current  
-        # element is more than root,  
-        # then put it back.  
-        if diff>curr: 
-            pq.put((-curr,pi)) 
-            continue
-        else: 
-            # Else remove root and insert 
-            pq.put((-diff,neighb))           
-    # Print contents of heap. 
-    while(not pq.empty()): 
-        p,q = pq.get() 
-        a.append(str("{} ".format(arr[q])))
-    return a
+    gaussian : list
+        Sum of all Gaussian components over the x-axis space.
+
+    """
+    p = np.asarray(params, dtype=np.float64).reshape(-1, 3)
+    if njit is not None:
+        return _multimodal_kernel(np.asarray(x, dtype=np.float64), p)
+    mu, sigma, A = p[:, 0], p[:, 1], p[:, 2]
+    return (A[:, None] * np.exp(-(x - mu[:, None])**2 / (2 * sigma[:, None]**2))).sum(0)
 
-def _gauss(x, x0, sigma, a):
+def _multimodal_jac(x, *params):
     """
-    Create a Gaussian distribution for a given x-axis linsapce and Gaussian parameters.
+    Analytic Jacobian of _multimodal with respect to its parameters,
+    so curve_fit does not have to build one by finite differences.
 
     Parameters
     ----------
     x : list
         x-axis distribution.
-    x0 : float
-        Mean x-value for Gaussian.
-    sigma : float
-        Gaussian sigma, related to FWHM.
-    a : float
-        Gaussian amplitude.
+    *params : float
+        Flattened Gaussian parameters, three (mu, sigma, A) per component.
 
     Returns
     -------
-    gaussian : list
-        y-axis Gaussian distribution over the x-axis space.
+    jac : list of lists
+        (len(x), 3K) array of partial derivatives, column-ordered as
+        (mu, sigma, A) per component.
 
     """
-
-    if sigma != 0:
-        gaussian = abs(a*np.exp(-(x-x0)**2/(2*sigma**2)))
-    return gaussian
-
-def _bimodal(x,mu1,sigma1,A1,mu2,sigma2,A2):
-    """ Two gaussians """
-    return _gauss(x,mu1,sigma1,A1)+_gauss(x,mu2,sigma2,A2)
-
-def _trimodal(x,mu1,sigma1,A1,mu2,sigma2,A2,mu3,sigma3,A3):
-    """ Three gaussians """
-    return _gauss(x,mu1,sigma1,A1)+_gauss(x,mu2,sigma2,A2)+_gauss(x,mu3,sigma3,A3)
-
-def _quadmodal(x,mu1,sigma1,A1,mu2,sigma2,A2,mu3,sigma3,A3,mu4,sigma4,A4):
-    """ Four gaussians """
-    return _gauss(x,mu1,sigma1,A1)+_gauss(x,mu2,sigma2,A2)+_gauss(x,mu3,sigma3,A3)+_gauss(x,mu4,sigma4,A4)
-
-def _quinmodal(x,mu1,sigma1,A1,mu2,sigma2,A2,mu3,sigma3,A3,mu4,sigma4,A4,mu5,sigma5,A5):
-    """ Five gaussians """
-    return _gauss(x,mu1,sigma1,A1)+_gauss(x,mu2,sigma2,A2)+_gauss(x,mu3,sigma3,A3)+_gauss(x,mu4,sigma4,A4)+_gauss(x,mu5,sigma5,A5)
-
-def _sexmodal(x,mu1,sigma1,A1,mu2,sigma2,A2,mu3,sigma3,A3,mu4,sigma4,A4,mu5,sigma5,A5,mu6,sigma6,A6):
-    """ Six gaussians """
-    return _gauss(x,mu1,sigma1,A1)+_gauss(x,mu2,sigma2,A2)+_gauss(x,mu3,sigma3,A3)+_gauss(x,mu4,sigma4,A4)+_gauss(x,mu5,sigma5,A5)+_gauss(x,mu6,sigma6,A6)   
-
-def _septmodal(x,mu1,sigma1,A1,mu2,sigma2,A2,mu3,sigma3,A3,mu4,sigma4,A4,mu5,sigma5,A5,mu6,sigma6,A6,mu7,sigma7,A7):
-    """ Seven gaussians """
-    return _gauss(x,mu1,sigma1,A1)+_gauss(x,mu2,sigma2,A2)+_gauss(x,mu3,sigma3,A3)+_gauss(x,mu4,sigma4,A4)+_gauss(x,mu5,sigma5,A5)+_gauss(x,mu6,sigma6,A6)+_gauss(x,mu7,sigma7,A7)    
-
-def _octomodal(x,mu1,sigma1,A1,mu2,sigma2,A2,mu3,sigma3,A3,mu4,sigma4,A4,mu5,sigma5,A5,mu6,sigma6,A6,mu7,sigma7,A7,mu8,sigma8,A8):
-    """ Eight gaussians """
-    return _gauss(x,mu1,sigma1,A1)+_gauss(x,mu2,sigma2,A2)+_gauss(x,mu3,sigma3,A3)+_gauss(x,mu4,sigma4,A4)+_gauss(x,mu5,sigma5,A5)+_gauss(x,mu6,sigma6,A6)+_gauss(x,mu7,sigma7,A7)+_gauss(x,mu8,sigma8,A8)    
-
-def _nonamodal(x,mu1,sigma1,A1,mu2,sigma2,A2,mu3,sigma3,A3,mu4,sigma4,A4,mu5,sigma5,A5,mu6,sigma6,A6,mu7,sigma7,A7,mu8,sigma8,A8,mu9,sigma9,A9):
-    """ Nine gaussians """
-    return _gauss(x,mu1,sigma1,A1)+_gauss(x,mu2,sigma2,A2)+_gauss(x,mu3,sigma3,A3)+_gauss(x,mu4,sigma4,A4)+_gauss(x,mu5,sigma5,A5)+_gauss(x,mu6,sigma6,A6)+_gauss(x,mu7,sigma7,A7)+_gauss(x,mu8,sigma8,A8)+_gauss(x,mu9,sigma9,A9)      
-
-def _decamodal(x,mu1,sigma1,A1,mu2,sigma2,A2,mu3,sigma3,A3,mu4,sigma4,A4,mu5,sigma5,A5,mu6,sigma6,A6,mu7,sigma7,A7,mu8,sigma8,A8,mu9,sigma9,A9,mu10,sigma10,A10):
-    """ Ten gaussians """
-    return _gauss(x,mu1,sigma1,A1)+_gauss(x,mu2,sigma2,A2)+_gauss(x,mu3,sigma3,A3)+_gauss(x,mu4,sigma4,A4)+_gauss(x,mu5,sigma5,A5)+_gauss(x,mu6,sigma6,A6)+_gauss(x,mu7,sigma7,A7)+_gauss(x,mu8,sigma8,A8)+_gauss(x,mu9,sigma9,A9)+_gauss(x,mu10,sigma10,A10)        
+    p = np.asarray(params).reshape(-1, 3)
+    mu, sigma, A = p[:, 0], p[:, 1], p[:, 2]
+    dx = x - mu[:, None]
+    E = np.exp(-dx**2 / (2 * sigma[:, None]**2))
+    dmu = A[:, None] * E * dx / sigma[:, None]**2
+    dsigma = A[:, None] * E * dx**2 / sigma[:, None]**3
+    jac = np.empty((len(x), 3 * len(p)))
+    jac[:, 0::3] = dmu.T
+    jac[:, 1::3] = dsigma.T
+    jac[:, 2::3] = E.T
+    return jac
 
 def _integral(x, mu, sigma, A):
     """
@@ -192,9 +185,9 @@ def _integral(x, mu, sigma, A):
     Parameters
     ----------
     x : float
-        Upper limit for integral.
+        Upper limit for integral. May be an array of limits.
     mu : float
-        Gaussian mean.
+        Gaussian mean. May be an array of means.
     sigma : float
         Gaussian sigma.
     A : float
@@ -206,7 +199,7 @@ def _integral(x, mu, sigma, A):
         Area under Gaussian from negative infinity to x.
 
     """
-    integral = (A/2) * (1 + math.erf((x - mu) / (sigma * np.sqrt(2))))
+    integral = (A/2) * (1 + erf((x - mu) / (sigma * _SQRT2)))
     return integral
 
 
@@ -234,81 +227,101 @@ def _gauss_fit(distribution, traj1_len, gauss_bin, gauss_smooth):
 
     """
     
+    distribution = np.asarray(distribution)
     distr1 = distribution[:traj1_len]
     distr2 = distribution[traj1_len:]
-    
-    histox = np.histogram(distribution, bins=gauss_bin, density=True)[1]
-    histo1 = np.histogram(distr1, bins=gauss_bin, range=(min(histox),max(histox)), density=True)[0]
-    histo2 = np.histogram(distr2, bins=gauss_bin, range=(min(histox),max(histox)), density=True)[0]
-    
-    combined_histo = [(height1 + height2)/2 for height1,height2 in zip(histo1,histo2)]    
+
+    lo, hi = distribution.min(), distribution.max()
+    ##widen a degenerate range like np.histogram does
+    if lo == hi:
+        lo, hi = lo - 0.5, hi + 0.5
+    histox = np.linspace(lo, hi, gauss_bin+1)
+    histo1 = _density_histo(distr1, lo, hi, gauss_bin)
+    histo2 = _density_histo(distr2, lo, hi, gauss_bin)
+
+    combined_histo = (histo1 + histo2)/2
 
     distributionx = _smooth(histox[0:-1], gauss_smooth)
     ## Setting histrogram minimum to zero with uniform linear shift (for noisey distributions)
     distributiony = _smooth(combined_histo-min(combined_histo), gauss_smooth)
     
-    maxima = [distributiony[item] for item in argrelextrema(distributiony, np.greater)][0]
+    peak_idx = argrelextrema(distributiony, np.greater)[0]
+    maxima = distributiony[peak_idx]
     ## Obtain Gaussian guess params
     mean_pop=[]
     sigma_pop=[]
     num_closest_neighb=28
     ## Locate sigma from FWHM for each maxima
     sig_vals=[]
-    for extrema in maxima:
+    for extrema_index, extrema in zip(peak_idx, maxima):
         ## Finding closest values to half maximum
-        closest_yvals = _printKclosest(distributiony, len(distributiony), extrema*0.5, num_closest_neighb)
-        closest_xvals = [np.where(distributiony==float(closesty))[0][0] for closesty in closest_yvals]
+        diffs = np.abs(distributiony - extrema*0.5)
+        closest_xvals = np.argpartition(diffs, num_closest_neighb)[:num_closest_neighb]
 
-        mean_xval = distributionx[np.where(distributiony==extrema)[0][0]]
+        mean_xval = distributionx[extrema_index]
         half_max_xval = _find_nearest(distributionx[closest_xvals],mean_xval)
-        
+
         FWHM = np.absolute(half_max_xval - mean_xval)
-        sigma = FWHM /(2*(np.sqrt(2*np.log(2)))) 
-        sig_vals.append(sigma)        
-        
+        sigma = FWHM /(2*(np.sqrt(2*np.log(2))))
+        sig_vals.append(sigma)
+
+    ##a zero-width guess cannot be fitted; fail here so that the
+    ##bin-number retry in smart_gauss_fit engages
+    if 0 in sig_vals:
+        raise ValueError
+
     ##the mean x of the gaussian is the value of x at the peak of y
-    mean_vals=[distributionx[np.where(distributiony==extrema)[0][0]] for extrema in maxima]
+    mean_vals = distributionx[peak_idx]
     for extr_num in range(len(maxima)):
         mean_pop.append(mean_vals[extr_num])
         sigma_pop.append(sig_vals[extr_num])
         
     ##x is the space of angles
-    Gauss_xvals=np.linspace(min(distribution),max(distribution),10000)                
-    ##choosing the fitting mode
-    peak_number=[_gauss,_bimodal,_trimodal,_quadmodal,_quinmodal,_sexmodal,_septmodal,_octomodal,_nonamodal,_decamodal]
-    mode=peak_number[len(sig_vals)-1]    
+    Gauss_xvals=np.linspace(min(distribution),max(distribution),10000)
     expected=[]
-    
+
     for param_num in range(len(mean_pop)):
         expected.append(mean_pop[param_num])
         expected.append(sigma_pop[param_num])
-        expected.append(maxima[param_num])    
+        expected.append(maxima[param_num])
 
-    params, cov = curve_fit(mode,distributionx,distributiony,expected,maxfev=1000000)   
+    ##the number of components is inferred from the length of the guess
+    params, cov = curve_fit(_multimodal,distributionx,distributiony,expected,maxfev=1000000,
+                            jac=_multimodal_jac,check_finite=False,ftol=1e-5,xtol=1e-5)
+    ##amplitudes may come out negative; only their magnitude is meaningful
+    params[2::3] = np.abs(params[2::3])
 
-    gaussians=[]
-    gauss_num_space=np.linspace(0,(len(params))-3,int(len(params)/3))    
+    gauss_params = params.reshape(-1,3)
+    ##areas between the distribution limits for all components in one call
+    int_lims = np.array([min(distribution),max(distribution)])
+    integrals = _integral(int_lims[:,None], gauss_params[:,0], gauss_params[:,1], gauss_params[:,2])
+
+    ##single broadcast exp over all surviving components instead of one pass each
+    kept = gauss_params[np.abs(integrals[1]-integrals[0])>0.02]
+    mu, sigma, A = kept[:,0], kept[:,1], kept[:,2]
+    gaussians = list(np.abs(A)[:,None]*np.exp(-(Gauss_xvals-mu[:,None])**2/(2*sigma[:,None]**2)))
 
-    for gauss_index in gauss_num_space:
-        intmax = _integral(max(distribution),
-                           params[0+int(gauss_index)], 
-                           params[1+int(gauss_index)], 
-                           params[2+int(gauss_index)])
-        
-        intmin = _integral(min(distribution),
-                           params[0+int(gauss_index)],
-                           params[1+int(gauss_index)], 
-                           params[2+int(gauss_index)])
-        
-        if np.abs(intmax-intmin)>0.02:
-            gaussians.append(_gauss(Gauss_xvals, 
-                                    params[0+int(gauss_index)],
-                                    params[1+int(gauss_index)], 
-                                    params[2+int(gauss_index)]))
-            
     return gaussians, Gauss_xvals
 
 
+##fitted gaussians keyed on (distribution digest, fit parameters), so that
+##repeated fits of an identical distribution skip the histogram and curve_fit
+_gauss_fit_cache = {}
+_GAUSS_FIT_CACHE_SIZE = 64
+
+##bound on bin-adjust retries, matching the length of the interleaved
+##+1/-1/+2/-2 array the retry loop used to index into
+_MAX_BIN_ATTEMPTS = 19998
+
+
+def _bin_delta(attempt_no):
+    """
+    Bin-number adjustment for the attempt_no-th retry, alternating
+    +/- values to keep the change minimal: -1, +1, -2, +2, ...
+    """
+    return ((attempt_no // 2) + 1) * (1 if attempt_no % 2 else -1)
+
+
 def smart_gauss_fit(distr, traj1_len, gauss_bins=180, gauss_smooth=None, write_name=None):
     """
     Obtaining the gaussians to fit the distribution into a Gaussian mix. 
@@ -343,21 +356,37 @@ def smart_gauss_fit(distr, traj1_len, gauss_bins=180, gauss_smooth=None, write_n
    
     trial = 0
     attempt_no = 0
-    
-    ##making a list of +/- values for bin trials to ensure minimal change
-    bin_adjust_up = np.array(range(1,10000))
-    bin_adjust_down = bin_adjust_up.copy()*-1
-    bin_adjust = np.insert(bin_adjust_up, np.arange(len(bin_adjust_down)), bin_adjust_down)
-    
+
+    ##only reuse previous fits for plain runs, so plot writes stay correct
+    distr_arr = np.asarray(distr)
+    use_cache = write_name is None
+    distr_digest = hash(distr_arr.tobytes()) if use_cache else None
+
     ##if clustering does not work for a given bin number then adjust the bin number
     while trial < 1:
+        cache_key = (distr_digest, distr_arr.size, traj1_len, gauss_bins, gauss_smooth)
+        if use_cache and cache_key in _gauss_fit_cache:
+            ##copy so callers mutating the result cannot corrupt the cache
+            stored_gaussians, stored_xvals = _gauss_fit_cache[cache_key]
+            gaussians = [gauss.copy() for gauss in stored_gaussians]
+            Gauss_xvals = stored_xvals.copy()
+            trial += 1
+            continue
         try:
-            gaussians, Gauss_xvals = _gauss_fit(distr, traj1_len, gauss_bins, gauss_smooth)
+            gaussians, Gauss_xvals = _gauss_fit(distr_arr, traj1_len, gauss_bins, gauss_smooth)
+            if use_cache:
+                if len(_gauss_fit_cache) >= _GAUSS_FIT_CACHE_SIZE:
+                    _gauss_fit_cache.pop(next(iter(_gauss_fit_cache)))
+                _gauss_fit_cache[cache_key] = ([gauss.copy() for gauss in gaussians],
+                                               Gauss_xvals.copy())
             trial += 1
         except:
             attempt_no += 1
             trial = 0
-            gauss_bins = bin_origin + bin_adjust[attempt_no]
+            ##give up once every bin count the old adjustment table covered has failed
+            if attempt_no >= _MAX_BIN_ATTEMPTS:
+                raise
+            gauss_bins = bin_origin + _bin_delta(attempt_no)
     
     ##only warn about clustering changes if specific parameters were input
     if bin_origin != 180 or smooth_origin is not None:
@@ -397,34 +426,38 @@ def get_intersects(gaussians, distribution, Gauss_xvals, write_plots=None,write_
     """
     ##adding the minimum angle value as the first boundary
     all_intersects=[min(distribution)]
-    mean_gauss_xval=[]
-    for gauss_num in range(len(gaussians)):
-        mean_gauss_xval.append(Gauss_xvals[list(gaussians[gauss_num]).index(max(gaussians[gauss_num]))])
-  
-    ##sort gaussians in order of their mean xval        
-    reorder_gaussians=[gaussians[mean_gauss_xval.index(mean)] for mean in sorted(mean_gauss_xval)]    
-    # reorder_gaussians=[gaussians[gauss_num] for gauss_num in reorder_indices]
-        
-    for gauss_index in range(len(reorder_gaussians)-1):    
-        ##Find indices between neighbouring gaussians
-        idx = np.argwhere(np.diff(np.sign(reorder_gaussians[gauss_index] - reorder_gaussians[gauss_index+1]))).flatten()
+    mean_gauss_xval=[Gauss_xvals[gauss.argmax()] for gauss in gaussians]
+
+    ##sort gaussians in order of their mean xval
+    reorder_gaussians=[gaussians[gauss_num] for gauss_num in np.argsort(mean_gauss_xval)]
+
+    ##find sign changes between all neighbouring gaussians in one broadcast pass
+    if len(reorder_gaussians) > 1:
+        stacked = np.stack(reorder_gaussians)
+        sign_changes = np.diff(np.sign(stacked[:-1] - stacked[1:]), axis=1)
+
+    for gauss_index in range(len(reorder_gaussians)-1):
+        ##Indices between neighbouring gaussians
+        idx = np.flatnonzero(sign_changes[gauss_index])
         if len(idx)==1:
             all_intersects.append(float(Gauss_xvals[idx][0]) )
         elif len(idx)!=0:
             ## Select the intersect with the maximum probability
-            intersect_ymax=max([reorder_gaussians[gauss_index][intersect] for intersect in idx])
-            intersect_ymax_index=[item for item in idx if reorder_gaussians[gauss_index][item]==intersect_ymax]            
+            intersect_ymax_index=idx[reorder_gaussians[gauss_index][idx].argmax()]
             all_intersects.append(float(Gauss_xvals[intersect_ymax_index]))
         ## For gaussian neighbours that don't intersect, set state limit as center between maxima
-        elif len(idx)==0:            
-            gauss_max1=list(reorder_gaussians[gauss_index]).index(max(reorder_gaussians[gauss_index]))
-            gauss_max2=list(reorder_gaussians[gauss_index+1]).index(max(reorder_gaussians[gauss_index+1]))
+        elif len(idx)==0:
+            gauss_max1=reorder_gaussians[gauss_index].argmax()
+            gauss_max2=reorder_gaussians[gauss_index+1].argmax()
             intersect =  0.5* np.abs(Gauss_xvals[gauss_max2] +  Gauss_xvals[gauss_max1])
             all_intersects.append(float(intersect))
             
     all_intersects.append(max(distribution))  
         
     if write_plots is True:
+        ##lazy imports keep matplotlib off the critical path for non-plotting runs
+        import os
+        import matplotlib.pyplot as plt
         if not os.path.exists('ssi_plots/'):
             os.makedirs('ssi_plots/')
         plt.figure()      
@@ -470,17 +503,53 @@ def determine_state_limits(distr, traj1_len, gauss_bins=180, gauss_smooth=None,
         State intersects for each cluster in numerical order.
 
     """
-    new_dist=distr.copy()
-    distribution=[item for item in new_dist if item != 10000.0]
+    distr_arr=np.asarray(distr)
+    occupancy_mask=distr_arr!=10000.0
+    distribution=distr_arr[occupancy_mask]
     ##obtaining the gaussian fit
     gaussians, Gauss_xvals = smart_gauss_fit(distribution, traj1_len, gauss_bins, gauss_smooth, write_name)
-    ##discretising each state by gaussian intersects       
-    intersection_of_states = get_intersects(gaussians, distribution, Gauss_xvals,  write_plots, write_name)   
-    if distr.count(10000.0)>=1:
-        intersection_of_states.append(20000.0)  
+    ##discretising each state by gaussian intersects
+    intersection_of_states = get_intersects(gaussians, distribution, Gauss_xvals,  write_plots, write_name)
+    if not occupancy_mask.all():
+        intersection_of_states.append(20000.0)
     
-    order_intersect=np.sort(intersection_of_states)  
-    return list(order_intersect)
+    ##intersects are already produced in ascending order of gaussian mean and
+    ##the sentinel is the largest value, so sorting is only a safety fallback
+    if np.any(np.diff(intersection_of_states) < 0):
+        intersection_of_states.sort()
+    return intersection_of_states
+
+def determine_state_limits_batch(distrs, traj1_len, n_jobs=-1, **kwargs):
+    """
+    Cluster many independent feature distributions into discrete states in
+    parallel. Each distribution is handled by determine_state_limits; with
+    joblib installed the features are spread over worker processes, which
+    scales near-linearly for the typical hundreds-of-features workload.
+    Without joblib the features are processed sequentially.
+
+    Parameters
+    ----------
+    distrs : list of lists
+        One distribution per feature.
+    traj1_len : int
+        Length of the first trajectory within each distribution.
+    n_jobs : int, optional
+        Number of joblib worker processes. The default is -1 (all cores).
+    **kwargs
+        Keyword arguments passed through to determine_state_limits.
+
+    Returns
+    -------
+    list of lists
+        State intersects for each feature, in input order.
+
+    """
+    try:
+        from joblib import Parallel, delayed
+    except ImportError:
+        return [determine_state_limits(distr, traj1_len, **kwargs) for distr in distrs]
+    return Parallel(n_jobs=n_jobs, prefer='processes')(
+        delayed(determine_state_limits)(distr, traj1_len, **kwargs) for distr in distrs)
 
 # -- Functions to operate on discrete states --
 